@@ -1,4 +1,5 @@
 from .internal import PhonyTarget as PhonyTarget
+from .internal import PymkContext as PymkContext
 from .internal import PymkException as PymkException
 from .internal import Target as Target
 from .internal import get_variable as get_variable
@@ -1,15 +1,17 @@
 """Internal implementation of pymk, do not import from here."""
 
-import collections
 import concurrent.futures
 import getopt
+import os
 import re
 import subprocess
 import sys
+import threading
+import uuid
 from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Sequence, TypeAlias
+from typing import Sequence, TypeAlias, cast
 
 TargetType: TypeAlias = 'Target  | PhonyTarget'
 Dependency: TypeAlias = 'Target  | PhonyTarget | Path'
@@ -23,7 +25,11 @@ class PymkException(Exception):
 
 
 def simplify_dependency_input(depends: DependencyInput) -> dict[str, list[Dependency]]:
+    if isinstance(depends, (Target, PhonyTarget, Path)):
+        return {'__pymk_default_key__': [depends]}
     if isinstance(depends, dict):
+        if all(isinstance(v, list) for v in depends.values()):
+            return cast(dict[str, list[Dependency]], depends)
         return {k: list(v if isinstance(v, Sequence) else [v]) for k, v in depends.items()}
     return {'__pymk_default_key__': list(depends) if isinstance(depends, Sequence) else [depends]}
 
@@ -44,9 +50,25 @@ class Target:
     when the file has been updated.
     """
 
+    __slots__ = (
+        'cmd',
+        'output',
+        'depends',
+        '_depends_str',
+        '_flat_deps',
+        '_cmd_parts',
+        '_has_phony_dep',
+        '_total_deps',
+    )
+
     cmd: str
     output: Path
     depends: dict[str, list[Dependency]]
+    _depends_str: dict[str, str]
+    _flat_deps: list[Dependency]
+    _cmd_parts: list[tuple[bool, str]] | None
+    _has_phony_dep: bool
+    _total_deps: int
 
     def __init__(self, cmd: str, output: Path, depends: DependencyInput | None = None) -> None:
         if depends is None:
@@ -54,6 +76,11 @@ class Target:
         self.cmd = cmd
         self.output = output
         self.depends = simplify_dependency_input(depends)
+        self._depends_str = {k: ' '.join(str(x) for x in v) for k, v in self.depends.items()}
+        self._flat_deps = [d for v in self.depends.values() for d in v]
+        self._cmd_parts = parse_cmd_parts(cmd) if '$' in cmd else None
+        self._has_phony_dep = any(isinstance(d, PhonyTarget) for d in self._flat_deps)
+        self._total_deps = len(self._flat_deps)
 
     def __str__(self) -> str:
         return str(self.output)
@@ -76,10 +103,25 @@ class PhonyTarget:
     PhonyTarget('build', help='Build the binary', depends=exe_target)
     """
 
+    __slots__ = (
+        'name',
+        'cmd',
+        'depends',
+        'help',
+        '_depends_str',
+        '_flat_deps',
+        '_cmd_parts',
+        '_total_deps',
+    )
+
     name: str
     cmd: str | None
     depends: dict[str, list[Dependency]]
     help: str | None
+    _depends_str: dict[str, str]
+    _flat_deps: list[Dependency]
+    _cmd_parts: list[tuple[bool, str]] | None
+    _total_deps: int
 
     def __init__(
         self,
@@ -94,6 +136,10 @@ class PhonyTarget:
         self.cmd = cmd
         self.depends = simplify_dependency_input(depends)
         self.help = help
+        self._depends_str = {k: ' '.join(str(x) for x in v) for k, v in self.depends.items()}
+        self._flat_deps = [d for v in self.depends.values() for d in v]
+        self._cmd_parts = parse_cmd_parts(cmd) if cmd and '$' in cmd else None
+        self._total_deps = len(self._flat_deps)
 
     def __str__(self) -> str:
         return self.name
@@ -126,22 +172,55 @@ class Arguments:
                         args.error = f'invalid jobs integer "{val}"'
                 case '-D':
                     var, *rest = val.split('=', maxsplit=1)
-                    args.variables[var] = rest[0] if rest else ''
+                    args.variables[sys.intern(var)] = rest[0] if rest else ''
                 case _:
                     raise AssertionError('unreachable')
         return args
 
 
+@dataclass
+class PymkContext:
+    """
+    Holds the mutable state of one pymk run: the variables visible to
+    command expansion. Module-level pymk functions operate on a default
+    context; pass an explicit one to pymk.run to isolate runs from each
+    other, for example in tests.
+    """
+
+    variables: dict[str, str]
+
+
 ARGS = Arguments.parse(sys.argv[1:])
-VARIABLES = {k: v for k, v in ARGS.variables.items()}
+STDOUT_LOCK = threading.Lock()
+DEFAULT_CONTEXT = PymkContext({k: v for k, v in ARGS.variables.items()})
+VARIABLES = DEFAULT_CONTEXT.variables
 VAR_SUBST_REGEX = re.compile(r'\$(\$|\w+|\(\w+\)|{\w+})')
 
 
+def parse_cmd_parts(cmd: str) -> list[tuple[bool, str]]:
+    """
+    Split a cmd into (is_literal, text) segments, where non-literal
+    segments are variable names to resolve at expansion time. Done once
+    at target construction so expansion never re-scans the cmd.
+    """
+    parts = list[tuple[bool, str]]()
+    pos = 0
+    for m in VAR_SUBST_REGEX.finditer(cmd):
+        if pos != m.start():
+            parts.append((True, cmd[pos : m.start()]))
+        var = ''.join(c for c in m.group(1) if c not in '(){}')
+        parts.append((True, '$') if var == '$' else (False, sys.intern(var)))
+        pos = m.end()
+    if pos != len(cmd):
+        parts.append((True, cmd[pos:]))
+    return parts
+
+
 def set_variable(**variables: str) -> None:
     """Set one or more pymk variables"""
     for k, v in variables.items():
         if k not in ARGS.variables:
-            VARIABLES[k] = v
+            VARIABLES[sys.intern(k)] = v
 
 
 def get_variable(var: str, default: str | None = None) -> str | None:
@@ -149,127 +228,299 @@ def get_variable(var: str, default: str | None = None) -> str | None:
     return VARIABLES.get(var, default)
 
 
-def expand_cmd(t: TargetType) -> str:
-    def get_variable(m: re.Match[str]) -> str:
-        var = ''.join(c for c in m.group(1) if c not in '(){}')
-        if var == '$':
-            return '$'
-        if var == 'OUTPUT' and isinstance(t, Target):
-            return str(t.output)
-        if var in t.depends:
-            return ' '.join(str(x) for x in t.depends[var])
-        if var in VARIABLES:
-            return VARIABLES[var]
-        raise PymkException(f'Unset variable "${var}"')
-
+def expand_cmd(t: TargetType, variables: dict[str, str]) -> str:
     assert t.cmd
-    return VAR_SUBST_REGEX.sub(get_variable, t.cmd)
+    if t._cmd_parts is None:
+        return t.cmd
+
+    output = str(t.output) if isinstance(t, Target) else None
+    depends_str = t._depends_str
+    parts = list[str]()
+    for literal, text in t._cmd_parts:
+        if literal:
+            parts.append(text)
+        elif text == 'OUTPUT' and output is not None:
+            parts.append(output)
+        elif (value := depends_str.get(text)) is not None:
+            parts.append(value)
+        elif (value := variables.get(text)) is not None:
+            parts.append(value)
+        else:
+            raise PymkException(f'Unset variable "${text}"')
+    return ''.join(parts)
+
+
+class BashWorker:
+    """
+    A long-lived bash process that commands are sent to over stdin,
+    instead of paying for a fork+exec of a new bash per command.
+    Each command is delivered as a quoted heredoc and eval'd in a
+    subshell with stdin from /dev/null, so its syntax errors, stdin
+    reads, and cwd/env changes stay confined to it instead of
+    corrupting the worker. The exit code of each command is recovered
+    by echoing a sentinel after it and scanning the output for that
+    sentinel. The sentinel carries a random per-worker token so command
+    output cannot collide with it.
+    """
 
+    process: subprocess.Popen[bytes]
+    sentinel: bytes
+    heredoc_eof: str
+
+    def __init__(self) -> None:
+        self.process = subprocess.Popen(
+            ['bash'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        token = uuid.uuid4().hex
+        self.sentinel = f'__pymk_cmd_done_{token}__'.encode()
+        self.heredoc_eof = f'__pymk_cmd_eof_{token}__'
+
+    def frame_cmd(self, cmd: str) -> bytes:
+        lines = [
+            f"IFS= read -r -d '' __pymk_cmd <<'{self.heredoc_eof}'",
+            cmd,
+            self.heredoc_eof,
+            '( eval "$__pymk_cmd" ) </dev/null',
+            f'echo "{self.sentinel.decode()} $?"',
+            '',
+        ]
+        return '\n'.join(lines).encode()
+
+    def run_cmd(self, cmd: str) -> int:
+        assert self.process.stdin and self.process.stdout
+        self.process.stdin.write(self.frame_cmd(cmd))
+        output = list[bytes]()
+        try:
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    # The command made bash itself exit; report its exit code as the command's.
+                    self.process.stdin.close()
+                    return self.process.wait()
+                before, sentinel, status = line.partition(self.sentinel)
+                if sentinel:
+                    if before:
+                        output.append(before)
+                    try:
+                        return int(status)
+                    except ValueError:
+                        raise PymkException('bash worker sentinel desync') from None
+                output.append(line)
+        finally:
+            if output:
+                with STDOUT_LOCK:
+                    sys.stdout.write(b''.join(output).decode(errors='replace'))
 
-def execute_target_command(t: TargetType) -> TargetType:
-    cmd = expand_cmd(t)
-    print(cmd)
-    exitcode = subprocess.run('bash', input=cmd.encode('utf-8')).returncode
-    if exitcode != 0:
-        raise PymkException(f'Target "{t}" failed. ({exitcode=})')
-    return t
+    def close(self) -> None:
+        assert self.process.stdin
+        self.process.stdin.close()
+        self.process.wait()
 
 
 def modified_time(t: Path | Target) -> int:
     f = t if isinstance(t, Path) else t.output
-    return f.stat().st_mtime_ns
+    return os.stat(f).st_mtime_ns
 
 
-def up_to_date(t: Target, modified_times: dict[Path | Target, int]) -> bool:
+def try_modified_time(t: Path | Target) -> int | None:
     try:
-        mtime = modified_time(t)
+        return modified_time(t)
     except FileNotFoundError:
-        return False
-    modified_times[t] = mtime
-    for dependencies in t.depends.values():
-        for dep in dependencies:
-            if isinstance(dep, PhonyTarget):
-                return False
-            time = modified_times[dep]
-            if time > mtime:
-                return False
-    return True
-
-
-def build_execution_dag(targets: list[PhonyTarget]) -> tuple[dict[Dependency, list[TargetType]], list[Dependency]]:
-    dag = dict[Dependency, list[TargetType]]()
-    leafs = list[Dependency]()
-
-    seen = set[Dependency]()
-    q = collections.deque[Dependency](targets)
+        return None
+
+
+def up_to_date(t: Target, max_dep_mtime: int) -> int | None:
+    """Return the target's mtime if it is at least as new as all its dependencies, else None."""
+    if t._has_phony_dep:
+        return None
+    mtime = try_modified_time(t)
+    if mtime is None or mtime < max_dep_mtime:
+        return None
+    return mtime
+
+
+@dataclass
+class ExecutionDag:
+    """
+    The dependency graph with each reachable node assigned a dense
+    integer id, so the scheduler can track edges and remaining
+    dependency counts with plain list indexing instead of hashing
+    Target/PhonyTarget/Path objects on every event.
+    """
+
+    nodes: list[Dependency]
+    dependants: list[list[int]]
+    deps_left: list[int]
+    max_dep_mtime: list[int]
+    ready: list[int]
+
+
+def build_execution_dag(targets: list[PhonyTarget]) -> ExecutionDag:
+    nodes = list[Dependency]()
+    id_of = dict[Dependency, int]()
+    dependants = list[list[int]]()
+    deps_left = list[int]()
+    max_dep_mtime = list[int]()
+    ready = list[int]()
+
+    def add_node(t: Dependency) -> int:
+        id_of[t] = len(nodes)
+        nodes.append(t)
+        dependants.append([])
+        deps_left.append(0)
+        max_dep_mtime.append(0)
+        return id_of[t]
+
+    q = [add_node(t) for t in targets if t not in id_of]
     while q:
-        t = q.pop()
-        if isinstance(t, Path) or not t.depends:
-            leafs.append(t)
+        i = q.pop()
+        t = nodes[i]
+        if isinstance(t, Path) or not t._flat_deps:
+            ready.append(i)
             continue
-        for dependencies in t.depends.values():
-            for target in dependencies:
-                if target not in dag:
-                    dag[target] = []
-                dag[target].append(t)
-                if target not in seen:
-                    seen.add(target)
-                    q.append(target)
-    return dag, leafs
+        deps_left[i] = t._total_deps
+        for target in t._flat_deps:
+            j = id_of.get(target)
+            if j is None:
+                j = add_node(target)
+                q.append(j)
+            dependants[j].append(i)
+    return ExecutionDag(nodes, dependants, deps_left, max_dep_mtime, ready)
+
+
+def compute_heights(dependants: list[list[int]]) -> list[int]:
+    """
+    Compute the length of the longest chain of dependants above each
+    node. Scheduling ready nodes in falling height order prioritizes
+    the critical path of the build.
+    """
+    heights = [-1] * len(dependants)
+    for i in range(len(dependants)):
+        stack = [i]
+        while stack:
+            j = stack[-1]
+            if heights[j] >= 0:
+                stack.pop()
+                continue
+            if pending := [d for d in dependants[j] if heights[d] < 0]:
+                stack.extend(pending)
+                continue
+            heights[j] = 1 + max((heights[d] for d in dependants[j]), default=0)
+            stack.pop()
+    return heights
 
 
 class TargetExecutor:
+    context: PymkContext
     executor: ThreadPoolExecutor
-    futures: set[Future[TargetType]]
-    dependants: dict[Dependency, list[TargetType]]
-    deps_left: dict[TargetType, int]
-    modified_times: dict[Path | Target, int]
-
-    def __init__(self, jobs: int) -> None:
-        self.executor = ThreadPoolExecutor(max_workers=jobs if jobs > 0 else None)
+    futures: set[Future[int]]
+    dag: ExecutionDag
+    modified_times: dict[Dependency, int]
+    ready: list[int]
+    bash_workers: list[BashWorker]
+    thread_state: threading.local
+    lock: threading.Lock
+
+    def __init__(self, jobs: int, context: PymkContext) -> None:
+        if jobs <= 0:
+            jobs = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        self.context = context
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
         self.futures = set()
-        self.dependants = {}
-        self.deps_left = {}
+        self.dag = ExecutionDag([], [], [], [], [])
         self.modified_times = {}
-
-    def exec_command(self, t: TargetType) -> None:
-        self.futures.add(self.executor.submit(execute_target_command, t))
-
-    def on_finished(self, t: Dependency) -> None:
+        self.ready = []
+        self.bash_workers = []
+        self.thread_state = threading.local()
+        self.lock = threading.Lock()
+
+    def execute_target_command(self, i: int) -> int:
+        t = self.dag.nodes[i]
+        assert not isinstance(t, Path)
+        cmd = expand_cmd(t, self.context.variables)
+        print(cmd)
+        worker: BashWorker | None = getattr(self.thread_state, 'bash_worker', None)
+        if worker is None:
+            worker = self.thread_state.bash_worker = BashWorker()
+            with self.lock:
+                self.bash_workers.append(worker)
+        exitcode = worker.run_cmd(cmd)
+        if worker.process.returncode is not None:
+            self.thread_state.bash_worker = None
+        if exitcode != 0:
+            raise PymkException(f'Target "{t}" failed. ({exitcode=})')
+        return i
+
+    def exec_command(self, i: int) -> None:
+        self.futures.add(self.executor.submit(self.execute_target_command, i))
+
+    def on_finished(self, i: int) -> None:
+        t = self.dag.nodes[i]
+        mtime = 0
         if not isinstance(t, PhonyTarget):
-            try:
-                self.modified_times[t] = modified_time(t)
-            except FileNotFoundError as e:
-                raise PymkException(f'Expected {t} to exist') from e
-        for dependant in self.dependants.get(t, []):
-            if dependant not in self.deps_left:
-                self.deps_left[dependant] = sum(len(x) for x in dependant.depends.values())
-            self.deps_left[dependant] -= 1
-            if not self.deps_left[dependant]:
-                self.run_target(dependant)
-
-    def run_target(self, t: Dependency) -> None:
-        match t:
-            case Path():
-                if not t.exists():
-                    raise PymkException(f'File dependency "{t}" does not exist.')
-            case Target():
-                if not up_to_date(t, self.modified_times):
-                    return self.exec_command(t)
-            case PhonyTarget():
-                if t.cmd:
-                    return self.exec_command(t)
-        self.on_finished(t)
+            if t not in self.modified_times:
+                try:
+                    self.modified_times[t] = modified_time(t)
+                except FileNotFoundError as e:
+                    raise PymkException(f'Expected {t} to exist') from e
+            mtime = self.modified_times[t]
+        deps_left = self.dag.deps_left
+        max_dep_mtime = self.dag.max_dep_mtime
+        for j in self.dag.dependants[i]:
+            if mtime > max_dep_mtime[j]:
+                max_dep_mtime[j] = mtime
+            deps_left[j] -= 1
+            if not deps_left[j]:
+                self.ready.append(j)
+
+    def run_target(self, i: int) -> None:
+        t = self.dag.nodes[i]
+        if type(t) is Target:
+            if (mtime := up_to_date(t, self.dag.max_dep_mtime[i])) is None:
+                return self.exec_command(i)
+            self.modified_times[t] = mtime
+        elif type(t) is PhonyTarget:
+            if t.cmd:
+                return self.exec_command(i)
+        else:
+            assert isinstance(t, Path)
+            if t not in self.modified_times:
+                try:
+                    self.modified_times[t] = modified_time(t)
+                except FileNotFoundError as e:
+                    raise PymkException(f'File dependency "{t}" does not exist.') from e
+        self.on_finished(i)
 
     def execute(self, targets: list[PhonyTarget]) -> None:
-        self.dependants, leafs = build_execution_dag(targets)
-        with self.executor:
-            for leaf in leafs:
-                self.run_target(leaf)
-            while self.futures:
-                done, self.futures = concurrent.futures.wait(self.futures, return_when=FIRST_COMPLETED)
-                for f in done:
-                    self.on_finished(f.result())
+        self.dag = build_execution_dag(targets)
+        heights = compute_heights(self.dag.dependants)
+        self.ready = self.dag.ready
+        self.ready.sort(key=heights.__getitem__, reverse=True)
+        for dependants in self.dag.dependants:
+            dependants.sort(key=heights.__getitem__, reverse=True)
+        try:
+            with self.executor:
+                path_leafs = [p for i in self.ready if isinstance(p := self.dag.nodes[i], Path)]
+                for path, mtime in zip(path_leafs, self.executor.map(try_modified_time, path_leafs), strict=True):
+                    if mtime is not None:
+                        self.modified_times[path] = mtime
+                while self.ready or self.futures:
+                    while self.ready:
+                        ready, self.ready = self.ready, []
+                        for i in ready:
+                            self.run_target(i)
+                    if not self.futures:
+                        break
+                    done, self.futures = concurrent.futures.wait(self.futures, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        self.on_finished(f.result())
+        finally:
+            for worker in self.bash_workers:
+                worker.close()
 
 
 def exit_help(targets: Sequence[PhonyTarget], error: str | None = None) -> None:
@@ -284,22 +535,23 @@ def exit_help(targets: Sequence[PhonyTarget], error: str | None = None) -> None:
         print(f'  {t.name.ljust(maxlen)}  {t.help if t.help else ""}'.rstrip())
     print()
     print('OPTIONS:')
-    print('  -j, --jobs JOBS        number of parallel jobs (default 0=infinite)')
+    print('  -j, --jobs JOBS        number of parallel jobs (defaults to the number of available CPUs)')
     print('  -D, --var VAR[=VALUE]  set a variable (example -DCC=gcc-11)')
     print('  -h, --help             print this help message and exit')
     sys.exit(0)
 
 
-def run(jobs: int, targets: list[PhonyTarget]) -> int:
+def run(jobs: int, targets: list[PhonyTarget], context: PymkContext | None = None) -> int:
     """
     Run the pymk build system, without generating
     help text, parsing arguments, or exiting the
     program afterwards.
 
-    Builds ALL PhonyTarget:s passed in.
+    Builds ALL PhonyTarget:s passed in, using the
+    default context unless an explicit one is given.
     """
     try:
-        executor = TargetExecutor(jobs)
+        executor = TargetExecutor(jobs, context if context is not None else DEFAULT_CONTEXT)
         executor.execute(targets)
     except PymkException as e:
         print('pymk:', e)
@@ -1,4 +1,6 @@
 import io
+import os
+import uuid
 from contextlib import contextmanager, redirect_stdout
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -10,12 +12,19 @@ import pymk
 from pymk import PhonyTarget, Target
 
 
-@pytest.fixture
-def tmpdir() -> Generator[Path, None, None]:
+@pytest.fixture(scope='session')
+def session_tmpdir() -> Generator[Path, None, None]:
     with TemporaryDirectory() as tmpdir_str:
         yield Path(tmpdir_str)
 
 
+@pytest.fixture
+def tmpdir(session_tmpdir: Path) -> Path:
+    subdir = session_tmpdir / uuid.uuid4().hex
+    subdir.mkdir()
+    return subdir
+
+
 @contextmanager
 def pymk_variables(variables: dict[str, str]) -> Generator[None, None, None]:
     pymk.set_variable(**variables)
@@ -25,9 +34,9 @@ def pymk_variables(variables: dict[str, str]) -> Generator[None, None, None]:
         pymk.internal.VARIABLES.clear()
 
 
-def run_pymk(targets: list[PhonyTarget]) -> tuple[int, str]:
+def run_pymk(targets: list[PhonyTarget], context: pymk.PymkContext | None = None) -> tuple[int, str]:
     with io.StringIO() as buf, redirect_stdout(buf):
-        status = pymk.run(0, targets)
+        status = pymk.run(0, targets, context)
         return status, buf.getvalue()
 
 
@@ -37,7 +46,40 @@ def test_trivial_command() -> None:
     assert output.strip() == 'echo hello world > /dev/null'
 
 
+def test_command_output() -> None:
+    status, output = run_pymk([PhonyTarget('x', cmd='printf foo')])
+    assert status == 0
+    assert 'foo' in output
+
+    status, output = run_pymk([PhonyTarget('x', cmd=r"printf '\xff\xfe\n'")])
+    assert status == 0
+
+    status, output = run_pymk([PhonyTarget('x', cmd="echo '__pymk_cmd_done__ banana'")])
+    assert status == 0
+    assert '__pymk_cmd_done__ banana' in output
+
+    status, output = run_pymk([PhonyTarget('x', cmd='echo "unterminated')])
+    assert status != 0
+
+    status, output = run_pymk([PhonyTarget('x', cmd='cat')])
+    assert status == 0
+
+    status, output = run_pymk([PhonyTarget('x', cmd='exit 3')])
+    assert status != 0
+    assert 'exitcode=3' in output
+
+    recovers = PhonyTarget('x', cmd='echo recovered > /dev/null', depends=PhonyTarget('w', cmd='exit 0'))
+    status, output = run_pymk([recovers])
+    assert status == 0
+    assert 'echo recovered > /dev/null' in output
+
+    leaky = PhonyTarget('w', cmd='cd /tmp && export LEAK=1')
+    status, output = run_pymk([PhonyTarget('x', cmd='test -z "$$LEAK"', depends=leaky)])
+    assert status == 0
+
+
 def test_var_expansion(tmpdir: Path) -> None:
+    tmp_txt = os.fspath(tmpdir / 'tmp.txt')
     with pymk_variables({'A': 'a', 'B': 'b', 'C': 'c', 'DEV_NULL': '/dev/null', 'ECHO': 'echo'}):
         refers_to_output = Target(cmd='touch $OUTPUT', output=tmpdir / 'tmp.txt')
         status, output = run_pymk(
@@ -51,8 +93,8 @@ def test_var_expansion(tmpdir: Path) -> None:
             ]
         )
         assert status == 0
-        assert f'touch {tmpdir / "tmp.txt"}' in output
-        assert f'echo {tmpdir / "tmp.txt"} > /dev/null' in output
+        assert f'touch {tmp_txt}' in output
+        assert f'echo {tmp_txt} > /dev/null' in output
         assert 'echo $VAR > /dev/null' in output
         assert 'echo abc > /dev/null' in output
         assert 'echo aab > /dev/null' in output
@@ -68,17 +110,26 @@ def test_var_expansion(tmpdir: Path) -> None:
     assert '$OUTPUT' in output
 
 
+def test_context_isolation() -> None:
+    targets = [PhonyTarget('x', cmd='echo $GREETING > /dev/null')]
+    for greeting in ('hello', 'goodbye'):
+        status, output = run_pymk(targets, pymk.PymkContext({'GREETING': greeting}))
+        assert status == 0
+        assert f'echo {greeting} > /dev/null' in output
+
+
 def test_simple_dependencies(tmpdir: Path) -> None:
+    a_txt, b_txt, c_txt, abc_txt = (os.fspath(tmpdir / f) for f in ('a.txt', 'b.txt', 'c.txt', 'abc.txt'))
     a = Target(cmd='echo a > $OUTPUT', output=tmpdir / 'a.txt')
     b = Target(cmd='echo b > $OUTPUT', output=tmpdir / 'b.txt')
     c = Target(cmd='echo c > $OUTPUT', output=tmpdir / 'c.txt')
     abc = Target(cmd='cat $FILES > $OUTPUT', depends={'FILES': [a, b, c]}, output=tmpdir / 'abc.txt')
     status, output = run_pymk([PhonyTarget('x', depends=abc)])
     assert status == 0
-    assert f'echo a > {tmpdir / "a.txt"}' in output
-    assert f'echo b > {tmpdir / "b.txt"}' in output
-    assert f'echo c > {tmpdir / "c.txt"}' in output
-    assert f'cat {tmpdir / "a.txt"} {tmpdir / "b.txt"} {tmpdir / "c.txt"} > {tmpdir / "abc.txt"}' in output
+    assert f'echo a > {a_txt}' in output
+    assert f'echo b > {b_txt}' in output
+    assert f'echo c > {c_txt}' in output
+    assert f'cat {a_txt} {b_txt} {c_txt} > {abc_txt}' in output
     assert (tmpdir / 'abc.txt').read_text() == 'a\nb\nc\n'
 
 